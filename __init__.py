@@ -7,6 +7,7 @@ from bpy.utils import register_class
 from bpy.utils import unregister_class
 
 import time
+import math
 
 bl_info = {
     "name": "SEAnim Support",
@@ -39,19 +40,26 @@ class ImportSEAnim(bpy.types.Operator, ImportHelper):
     bl_options = {'PRESET'}
 
     filename_ext = ".seanim"
-    filter_glob: StringProperty(default="*.seanim", options={'HIDDEN'})
+    # Compressed anims (.seanim.gz, etc.) are decompressed transparently
+    filter_glob: StringProperty(
+        default="*.seanim;*.seanim.gz;*.seanim.bz2;*.seanim.xz;*.seanim.lzma",
+        options={'HIDDEN'})
 
     files: CollectionProperty(type=bpy.types.PropertyGroup)
 
     def execute(self, context):
         # print("Selected: " + context.active_object.name)
         from . import import_seanim
+        cache = import_seanim.g_anim_cache
+        hits, misses = cache.hits, cache.misses
         start_time = time.process_time()
         result = import_seanim.load(
             self, context, **self.as_keywords(ignore=("filter_glob", "files")))
         if not result:
-            self.report({'INFO'}, "Import finished in %.4f sec." %
-                        (time.process_time() - start_time))
+            self.report({'INFO'}, "Import finished in %.4f sec. "
+                        "(Anim cache: %d hits, %d misses)" %
+                        (time.process_time() - start_time,
+                         cache.hits - hits, cache.misses - misses))
             return {'FINISHED'}
         else:
             self.report({'ERROR'}, result)
@@ -120,6 +128,24 @@ class ExportSEAnim(bpy.types.Operator, ExportHelper):
         description="Mark the animation as a looping animation",
         default=False)
 
+    reduce_keys: BoolProperty(
+        name="Reduce Keyframes",
+        description=("Remove keyframes that can be reproduced by "
+                     "interpolating between the surrounding keyframes"),
+        default=False)
+
+    reduce_tolerance: FloatProperty(
+        name="Tolerance",
+        description=("The maximum error allowed for the location and scale "
+                     "of removed keyframes"),
+        default=0.001, min=0.0, precision=4)
+
+    reduce_angle: FloatProperty(
+        name="Angle Tolerance",
+        description=("The maximum rotation error allowed for removed "
+                     "keyframes"),
+        subtype='ANGLE', default=math.radians(0.01), min=0.0, precision=3)
+
     use_actions: BoolProperty(
         name="Export All Actions",
         description="Export all actions to the target path",
@@ -151,6 +177,12 @@ class ExportSEAnim(bpy.types.Operator, ExportHelper):
         layout.prop(self, "is_looped")
         layout.prop(self, "every_frame")
 
+        box = layout.box()
+        box.prop(self, "reduce_keys")
+        if(self.reduce_keys):
+            box.prop(self, "reduce_tolerance")
+            box.prop(self, "reduce_angle")
+
         box = layout.box()
         box.prop(self, "use_actions")
         if(self.use_actions):
@@ -186,6 +218,67 @@ class ExportSEAnim(bpy.types.Operator, ExportHelper):
         return False
 
 
+class ClearSEAnimCache(bpy.types.Operator):
+    bl_idname = "seanim.clear_cache"
+    bl_label = "Clear Cache"
+    bl_description = ("Remove every parsed anim from the SEAnim import "
+                      "caches (in memory and on disk)")
+
+    def execute(self, context):
+        prefs = context.preferences.addons[__name__].preferences
+        removed = import_seanim.g_anim_cache.clear()
+        removed += prefs.get_disk_cache().clear()
+        self.report({'INFO'}, "Removed %d cached anims" % removed)
+        return {'FINISHED'}
+
+
+class SEAnimPreferences(AddonPreferences):
+    bl_idname = __name__
+
+    use_cache: BoolProperty(
+        name="Cache Parsed Anims",
+        description=("Store parsed anims on disk, so re-importing an "
+                     "unchanged file skips parsing it"),
+        default=False)
+
+    cache_path: StringProperty(
+        name="Cache Directory",
+        description=("The directory used to store parsed anims "
+                     "(uses the temp directory if empty)"),
+        subtype='DIR_PATH',
+        default="")
+
+    cache_size: IntProperty(
+        name="Cache Size (MB)",
+        description=("The least recently used anims are removed when the "
+                     "cache grows larger than this"),
+        default=1024, min=1)
+
+    memory_cache_size: IntProperty(
+        name="Memory Cache Size (MB)",
+        description=("The amount of memory used to keep parsed anims for "
+                     "the rest of the session (0 disables the cache)"),
+        default=512, min=0)
+
+    def get_disk_cache(self):
+        from . import cache_seanim
+        path = bpy.path.abspath(self.cache_path)
+        if not path:
+            path = cache_seanim.DiskCache.default_path()
+        return cache_seanim.DiskCache(path, self.cache_size * 1024 * 1024)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "memory_cache_size")
+        layout.prop(self, "use_cache")
+
+        col = layout.column()
+        col.enabled = self.use_cache
+        col.prop(self, "cache_path")
+        col.prop(self, "cache_size")
+        col.operator(ClearSEAnimCache.bl_idname)
+
+
 def get_operator(idname):
     op = bpy.ops
     for attr in idname.split("."):
@@ -208,7 +301,9 @@ def menu_func_seanim_export(self, context):
 
 classes = (
     ImportSEAnim,
-    ExportSEAnim
+    ExportSEAnim,
+    ClearSEAnimCache,
+    SEAnimPreferences
 )
 
 
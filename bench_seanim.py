@@ -0,0 +1,391 @@
+"""
+Benchmarks for seanim.py (doesn't require Blender)
+
+Run from the addon's directory:
+    python -m bench_seanim generate <directory>
+    python -m bench_seanim run <directory> [-o results.json] [--codecs]
+                                   [--no-memory]
+    python -m bench_seanim compare <old.json> <new.json>
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from array import array
+
+try:
+    from . import seanim as SEAnim
+except ImportError:
+    import seanim as SEAnim
+
+# <pep8 compliant>
+
+# The version of the results format
+RESULTS_VERSION = 1
+
+
+class Case(object):
+    """
+    The parameters of a synthetic seanim file
+    """
+    __slots__ = ('name', 'bones', 'frames', 'sparse', 'high_precision',
+                 'modifiers', 'notes', 'tracks')
+
+    def __init__(self, name, bones, frames, sparse=False,
+                 high_precision=False, modifiers=0, notes=0,
+                 tracks=('loc', 'rot', 'scale')):
+        self.name = name
+        self.bones = bones
+        self.frames = frames
+        # Sparse tracks only have a key for ~1 in 8 frames
+        self.sparse = sparse
+        self.high_precision = high_precision
+        self.modifiers = modifiers
+        self.notes = notes
+        self.tracks = tracks
+
+
+# The corpus covers the edges of the format: 1, 2 and 4 byte frame_t and
+# bone_t, float / double precision, modifiers, notes, sparse / dense keys
+# and 10 - 1000 bones
+CORPUS = (
+    Case('frame_u8', 20, 200, modifiers=2, notes=4),
+    Case('frame_u16', 20, 5000, notes=20),
+    Case('frame_u32', 4, 70000, sparse=True),
+    Case('bones_10', 10, 300),
+    Case('bones_100', 100, 300, modifiers=5, notes=10),
+    Case('bones_1000', 1000, 60, modifiers=20),
+    Case('bone_u16_modifiers', 300, 100, modifiers=100),
+    Case('bone_u32', 0x10000 + 16, 2, modifiers=4, tracks=('rot',)),
+    Case('double', 100, 300, high_precision=True, notes=10),
+    Case('sparse', 200, 2000, sparse=True, notes=50),
+    Case('notes', 10, 1000, notes=2000),
+    Case('rot_only', 100, 1000, tracks=('rot',)),
+)
+
+
+def generate_anim(case, seed=0):
+    """
+    Build an Anim with random keys for a Case
+    """
+    rng = random.Random(seed)
+    anim = SEAnim.Anim()
+    anim.header.framerate = 30
+    anim.header.animType = SEAnim.SEANIM_TYPE.SEANIM_TYPE_RELATIVE
+    typecode = 'd' if case.high_precision else 'f'
+
+    for index in range(case.bones):
+        bone = SEAnim.Bone()
+        bone.name = "bone_%d" % index
+
+        if case.sparse:
+            frames = sorted(rng.sample(range(case.frames),
+                                       max(2, case.frames // 8)))
+        else:
+            frames = list(range(case.frames))
+
+        for name, width in (('loc', 3), ('rot', 4), ('scale', 3)):
+            track = SEAnim.KeyTrack(width, case.high_precision)
+            if name in case.tracks:
+                track.frames = array('I', frames)
+                values = [rng.uniform(-1, 1)
+                          for _ in range(len(frames) * width)]
+                if name == 'rot':
+                    # Normalize each quaternion
+                    for i in range(0, len(values), 4):
+                        length = sum(x * x for x in values[i:i + 4]) ** 0.5
+                        for j in range(i, i + 4):
+                            values[j] /= length or 1
+                track.values = array(typecode, values)
+            setattr(bone, {'loc': 'posKeys', 'rot': 'rotKeys',
+                           'scale': 'scaleKeys'}[name], track)
+
+        anim.bones.append(bone)
+
+    step = max(1, case.bones // max(1, case.modifiers))
+    for index in range(0, case.bones, step)[:case.modifiers]:
+        anim.bones[index].useModifier = True
+        anim.bones[index].modifier = SEAnim.SEANIM_TYPE.SEANIM_TYPE_ABSOLUTE
+        anim.boneAnimModifiers.append(anim.bones[index])
+
+    for index in range(case.notes):
+        note = SEAnim.Note()
+        note.frame = rng.randrange(case.frames)
+        note.name = "note_%d" % index
+        anim.notes.append(note)
+
+    return anim
+
+
+def generate(directory, seed=0):
+    """
+    Write the synthetic corpus to directory
+    Returns the paths of the generated files
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for case in CORPUS:
+        path = os.path.join(directory, case.name + ".seanim")
+        generate_anim(case, seed).save(path, case.high_precision)
+        paths.append(path)
+    return paths
+
+
+def measure(function, repeat, memory=True):
+    """
+    Returns the best time (in seconds) of repeat calls to function, and the
+    peak memory allocated by an extra (traced) call
+    Tracing is much slower than the timed calls (especially for anims with
+    many small tracks), so it can be skipped by passing memory=False - the
+    peak is None in that case
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    if not memory:
+        return best, None
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def count_keys(path):
+    return sum(SEAnim.TrackIndex.for_file(path).counts)
+
+
+def benchmark_file(path, repeat, temp, memory=True):
+    """
+    Benchmark load, save, probe and round trip for a single file
+    Yields a result dict for each operation / loader mode
+    """
+    modes = [('list', {}), ('columnar', {'columnar': True})]
+    if SEAnim.numpy is not None:
+        modes.append(('numpy', {'use_numpy': True}))
+
+    header = SEAnim.probe(path, notes=False).header
+    high_precision = bool(header.dataPropertyFlags &
+                          SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+    keys = count_keys(path)
+    size = os.path.getsize(path)
+
+    def result(op, mode, seconds, peak):
+        return {
+            'file': os.path.basename(path),
+            'op': op,
+            'mode': mode,
+            'seconds': seconds,
+            'keys': keys,
+            'keys_per_sec': keys / seconds if seconds else None,
+            'bytes': size,
+            'peak_bytes': peak,
+        }
+
+    seconds, peak = measure(lambda: SEAnim.probe(path), repeat, memory)
+    yield result('probe', None, seconds, peak)
+
+    for mode, options in modes:
+        seconds, peak = measure(lambda: SEAnim.Anim(path, **options),
+                                repeat, memory)
+        yield result('load', mode, seconds, peak)
+
+        anim = SEAnim.Anim(path, **options)
+        seconds, peak = measure(lambda: anim.save(temp, high_precision),
+                                repeat, memory)
+        yield result('save', mode, seconds, peak)
+
+        def round_trip():
+            SEAnim.Anim(path, **options).save(temp, high_precision)
+            SEAnim.Anim(temp, **options)
+
+        seconds, peak = measure(round_trip, repeat, memory)
+        yield result('roundtrip', mode, seconds, peak)
+
+
+def benchmark_codecs(path, repeat, directory, memory=True):
+    """
+    Compare the size and load time of a file stored with each codec
+    Yields a result dict for each codec
+    """
+    anim = SEAnim.Anim(path, columnar=True)
+    high_precision = bool(anim.header.dataPropertyFlags &
+                          SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+    keys = count_keys(path)
+    size = os.path.getsize(path)
+
+    extensions = [''] + [extensions[0] for extensions, signature, codec,
+                         options in SEAnim.COMPRESSION]
+    for extension in extensions:
+        target = os.path.join(directory, "codec.seanim" + extension)
+        start = time.perf_counter()
+        anim.save(target, high_precision)
+        save_seconds = time.perf_counter() - start
+
+        seconds, peak = measure(
+            lambda: SEAnim.Anim(target, columnar=True), repeat, memory)
+        yield {
+            'file': os.path.basename(path),
+            'op': 'codec_load',
+            'mode': extension.lstrip('.') or 'raw',
+            'seconds': seconds,
+            'save_seconds': save_seconds,
+            'keys': keys,
+            'keys_per_sec': keys / seconds if seconds else None,
+            'bytes': os.path.getsize(target),
+            'ratio': size / os.path.getsize(target),
+            'peak_bytes': peak,
+        }
+        os.remove(target)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(paths, repeat=3, codecs=False, memory=True):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        temp = os.path.join(directory, "bench.seanim")
+        for path in paths:
+            for result in benchmark_file(path, repeat, temp, memory):
+                print_result(result)
+                results.append(result)
+            if codecs:
+                for result in benchmark_codecs(path, repeat, directory,
+                                               memory):
+                    print_result(result)
+                    results.append(result)
+
+    numpy = SEAnim.numpy
+    return {
+        'version': RESULTS_VERSION,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__ if numpy is not None else None,
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def result_key(result):
+    return (result['file'], result['op'], result['mode'])
+
+
+def print_result(result):
+    line = "%-24s %-10s %-9s %9.2f ms %12.0f keys/s" % (
+        result['file'], result['op'], result['mode'] or '-',
+        result['seconds'] * 1000, result['keys_per_sec'] or 0)
+    if result['peak_bytes'] is not None:
+        line += " %8.1f MB peak" % (result['peak_bytes'] / (1024 * 1024))
+    if 'ratio' in result:
+        line += " %5.2fx" % result['ratio']
+    print(line)
+
+
+def compare(old, new, threshold):
+    """
+    Print the change in time for every result in both runs
+    Returns the number of results that are slower than threshold allows
+    """
+    old_results = {result_key(result): result for result in old['results']}
+    regressions = 0
+    print("%s -> %s" % (old.get('revision'), new.get('revision')))
+    for result in new['results']:
+        previous = old_results.get(result_key(result))
+        if previous is None or not previous['seconds']:
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = " REGRESSION"
+            regressions += 1
+        print("%-24s %-10s %-9s %9.2f -> %9.2f ms (%+.1f%%)%s" % (
+            result['file'], result['op'], result['mode'] or '-',
+            previous['seconds'] * 1000, result['seconds'] * 1000,
+            (ratio - 1) * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="bench_seanim", description="Benchmark seanim.py")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser(
+        "generate", help="write the synthetic corpus to a directory")
+    command.add_argument("directory")
+    command.add_argument("--seed", type=int, default=0)
+
+    command = commands.add_parser(
+        "run", help="benchmark every seanim file in a directory")
+    command.add_argument("directory")
+    command.add_argument("-o", "--output",
+                         help="write the results to this JSON file")
+    command.add_argument("-n", "--repeat", type=int, default=3,
+                         help="the best of this many runs is reported")
+    command.add_argument("--codecs", action="store_true",
+                         help="also compare the size and load time of "
+                              "each compression codec")
+    command.add_argument("--no-memory", action="store_true",
+                         help="don't measure the peak memory (faster)")
+    command.add_argument("-k", "--filter", default="",
+                         help="only benchmark files containing this string")
+
+    command = commands.add_parser(
+        "compare", help="compare the results of two runs")
+    command.add_argument("old")
+    command.add_argument("new")
+    command.add_argument("-t", "--threshold", type=float, default=0.1,
+                         help="the slowdown reported as a regression "
+                              "(default: 0.1 = 10%%)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        for path in generate(args.directory, args.seed):
+            print("%s (%d bytes)" % (path, os.path.getsize(path)))
+        return 0
+
+    if args.command == "run":
+        paths = sorted(os.path.join(args.directory, name)
+                       for name in os.listdir(args.directory)
+                       if name.endswith(".seanim") and args.filter in name)
+        results = run(paths, max(1, args.repeat), args.codecs,
+                      not args.no_memory)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=1)
+        return 0
+
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    return 1 if compare(old, new, args.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
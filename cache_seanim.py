@@ -0,0 +1,394 @@
+import io
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+
+try:
+    from . import seanim as SEAnim
+except ImportError:
+    import seanim as SEAnim
+
+try:
+    # NumPy is optional (it ships with Blender)
+    import numpy
+except ImportError:
+    numpy = None
+
+# <pep8 compliant>
+
+
+def file_identity(filepath):
+    """
+    The (path, size, mtime) of a file, used to key its cache entries
+    """
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    return [filepath, stat.st_size, stat.st_mtime_ns]
+
+
+class DiskCache(object):
+    """
+    A persistent cache of parsed seanim files
+    Each entry holds the decoded keyframe tracks of a single file as flat
+    arrays, so a cache hit skips parsing the file entirely
+    Entries are keyed by the file's (path, size, mtime) and the cache
+    VERSION, and the least recently used entries are evicted whenever the
+    cache grows larger than max_size bytes
+    """
+    __slots__ = ('path', 'max_size')
+
+    MAGIC = b'SEAnmCch'
+    # Bump this whenever the parser or the entry layout changes
+    VERSION = 1
+    EXTENSION = '.cache'
+
+    # Magic, version, metadata size
+    PREFIX = struct.Struct('=8sHI')
+
+    # The width of each bone's loc, rot and scale tracks
+    WIDTHS = (3, 4, 3)
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def default_path():
+        return os.path.join(tempfile.gettempdir(), "seanim_cache")
+
+    def entry_path(self, identity):
+        key = repr((identity, self.VERSION)).encode("utf-8")
+        return os.path.join(self.path,
+                            hashlib.sha1(key).hexdigest() + self.EXTENSION)
+
+    def load(self, filepath, use_numpy=False):
+        """
+        Load the cached anim for filepath
+        The tracks are always KeyTracks (backed by NumPy arrays if use_numpy
+        is True and NumPy is available)
+        Returns None if there isn't an up to date entry for the file
+        """
+        try:
+            identity = file_identity(filepath)
+            path = self.entry_path(identity)
+            with open(path, "rb") as file:
+                buffer = file.read()
+            # Mark the entry as recently used
+            os.utime(path)
+        except (IOError, OSError):
+            return None
+
+        try:
+            return self.decode(buffer, identity, use_numpy)
+        except (ValueError, KeyError, AssertionError, struct.error):
+            return None
+
+    def save(self, filepath, anim):
+        """
+        Store an anim in the cache and evict the least recently used entries
+        if the cache has grown too large
+        """
+        try:
+            identity = file_identity(filepath)
+            buffer = self.encode(anim, identity)
+            os.makedirs(self.path, exist_ok=True)
+            # Entries are written to a temporary file first, so other readers
+            # never see a partially written entry
+            fd, temp_path = tempfile.mkstemp(dir=self.path)
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(buffer)
+                os.replace(temp_path, self.entry_path(identity))
+            except (IOError, OSError):
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError):
+            return
+
+        self.evict()
+
+    def encode(self, anim, identity):
+        header = anim.header
+        high_precision = (header.dataPropertyFlags &
+                          SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+        typecode = 'd' if high_precision else 'f'
+
+        modifiers = [anim.bones.index(bone)
+                     for bone in anim.boneAnimModifiers]
+        bones = []
+        counts = []
+        data = []
+        for bone in anim.bones:
+            bones.append([bone.name, bone.flags, bone.modifier])
+            for keys, width in zip((bone.posKeys, bone.rotKeys,
+                                    bone.scaleKeys), self.WIDTHS):
+                if isinstance(keys, SEAnim.LazyTrack):
+                    keys = keys.decode()
+                if not isinstance(keys, SEAnim.KeyTrack):
+                    track = SEAnim.KeyTrack(width, high_precision)
+                    for key in keys:
+                        track.append(key)
+                    keys = track
+
+                counts.append(len(keys))
+                if keys.uses_numpy():
+                    data.append(keys.frames.astype(numpy.uint32).tobytes())
+                    data.append(keys.values.astype(typecode).tobytes())
+                    continue
+                data.append(keys.frames.tobytes())
+                values = keys.values
+                if values.typecode != typecode:
+                    values = array(typecode, values)
+                data.append(values.tobytes())
+
+        metadata = {
+            'identity': identity,
+            'bones': bones,
+            'modifiers': modifiers,
+            'counts': counts,
+            'notes': [[note.frame, note.name] for note in anim.notes],
+        }
+
+        file = io.BytesIO()
+        anim.info.save(file)
+        header.save(file)
+        headers = file.getvalue()
+
+        metadata = json.dumps(metadata).encode("utf-8")
+        prefix = self.PREFIX.pack(self.MAGIC, self.VERSION, len(metadata))
+        return b''.join([prefix, metadata, headers] + data)
+
+    def decode(self, buffer, identity, use_numpy=False):
+        magic, version, size = self.PREFIX.unpack_from(buffer)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("Invalid cache entry")
+
+        offset = self.PREFIX.size
+        metadata = json.loads(buffer[offset:offset + size].decode("utf-8"))
+        if metadata['identity'] != identity:
+            raise ValueError("Cache entry is for a different file")
+        offset += size
+
+        file = io.BytesIO(buffer)
+        file.seek(offset)
+        anim = SEAnim.Anim()
+        anim.info = SEAnim.Info(file)
+        anim.header = header = SEAnim.Header(file)
+        offset = file.tell()
+
+        high_precision = (header.dataPropertyFlags &
+                          SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+        typecode = 'd' if high_precision else 'f'
+        value_size = 8 if high_precision else 4
+        use_numpy = use_numpy and numpy is not None
+
+        view = memoryview(buffer)
+        counts = iter(metadata['counts'])
+        for name, flags, modifier in metadata['bones']:
+            bone = SEAnim.Bone()
+            bone.name = name
+            bone.flags = flags
+            bone.modifier = modifier
+
+            tracks = []
+            for width in self.WIDTHS:
+                count = next(counts)
+                track = SEAnim.KeyTrack(width, high_precision)
+                frames = view[offset:offset + count * 4]
+                offset += count * 4
+                values = view[offset:offset + count * width * value_size]
+                offset += count * width * value_size
+                if use_numpy:
+                    track.frames = numpy.frombuffer(frames, numpy.uint32)
+                    track.values = numpy.frombuffer(values, typecode)
+                else:
+                    track.frames.frombytes(frames)
+                    track.values.frombytes(values)
+                tracks.append(track)
+
+            bone.posKeys, bone.rotKeys, bone.scaleKeys = tracks
+            bone.locKeyCount = len(bone.posKeys)
+            bone.rotKeyCount = len(bone.rotKeys)
+            bone.scaleKeyCount = len(bone.scaleKeys)
+            anim.bones.append(bone)
+
+        if offset != len(buffer):
+            raise ValueError("Invalid cache entry size")
+
+        for index in metadata['modifiers']:
+            bone = anim.bones[index]
+            bone.useModifier = True
+            anim.boneAnimModifiers.append(bone)
+
+        for frame, name in metadata['notes']:
+            note = SEAnim.Note()
+            note.frame = frame
+            note.name = name
+            anim.notes.append(note)
+
+        return anim
+
+    def entries(self):
+        """
+        Returns a list of (mtime, size, path) for each entry in the cache
+        """
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return entries
+
+        for name in names:
+            if not name.endswith(self.EXTENSION):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_size bytes
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        Returns the number of entries that were removed
+        """
+        removed = 0
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+        return removed
+
+
+class MemoryCache(object):
+    """
+    An in-memory LRU cache of parsed Anim objects
+    Anims are keyed by their file's (path, size, mtime), and the least
+    recently used anims are evicted once the estimated size of the cached
+    anims exceeds max_size bytes (a max_size of 0 disables the cache)
+    Cached anims are shared, so callers must not modify them
+    """
+    __slots__ = ('max_size', 'size', 'hits', 'misses', 'anims', 'lock')
+
+    # The estimated overhead (in bytes) of each bone / note
+    BONE_SIZE = 512
+    NOTE_SIZE = 128
+
+    def __init__(self, max_size=512 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (anim, estimated size)
+        self.anims = OrderedDict()
+        # Anims are loaded and stored from worker threads
+        self.lock = threading.Lock()
+
+    @classmethod
+    def estimate_size(cls, anim):
+        """
+        Estimate the memory used by an anim, based on its key counts and
+        precision
+        """
+        high_precision = (anim.header.dataPropertyFlags &
+                          SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+        value_size = 8 if high_precision else 4
+
+        size = (len(anim.bones) * cls.BONE_SIZE +
+                len(anim.notes) * cls.NOTE_SIZE)
+        for bone in anim.bones:
+            for keys, width in ((bone.posKeys, 3), (bone.rotKeys, 4),
+                                (bone.scaleKeys, 3)):
+                # 4 byte frame indices
+                size += len(keys) * (4 + width * value_size)
+        return size
+
+    def load(self, filepath):
+        """
+        Get the cached anim for filepath (None if it isn't cached)
+        """
+        try:
+            key = tuple(file_identity(filepath))
+        except OSError:
+            return None
+
+        with self.lock:
+            entry = self.anims.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.anims.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def save(self, filepath, anim):
+        """
+        Store an anim in the cache, evicting the least recently used anims
+        if the cache has grown too large
+        """
+        size = self.estimate_size(anim)
+        if size > self.max_size:
+            return
+
+        try:
+            key = tuple(file_identity(filepath))
+        except OSError:
+            return
+
+        with self.lock:
+            old = self.anims.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.anims[key] = (anim, size)
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        # The caller must hold the lock
+        while self.size > self.max_size and self.anims:
+            _, (_, size) = self.anims.popitem(last=False)
+            self.size -= size
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+    def clear(self):
+        """
+        Remove every anim from the cache
+        Returns the number of anims that were removed
+        """
+        with self.lock:
+            removed = len(self.anims)
+            self.anims.clear()
+            self.size = 0
+        return removed
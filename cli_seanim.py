@@ -0,0 +1,290 @@
+"""
+Command line tools for seanim files (doesn't require Blender)
+
+Run from the addon's directory:
+    python -m cli_seanim info <files / directories>
+    python -m cli_seanim validate <files / directories>
+    python -m cli_seanim optimize [-o OUTPUT] <files / directories>
+    python -m cli_seanim convert-precision --to double <files / directories>
+    python -m cli_seanim stats <files / directories>
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+try:
+    from . import seanim as SEAnim
+except ImportError:
+    import seanim as SEAnim
+
+# <pep8 compliant>
+
+# The file extensions that are processed when searching directories
+EXTENSIONS = ('.seanim',) + tuple(
+    '.seanim' + extension
+    for extensions, signature, codec, options in SEAnim.COMPRESSION
+    for extension in extensions)
+
+ANIM_TYPES = {
+    SEAnim.SEANIM_TYPE.SEANIM_TYPE_ABSOLUTE: "absolute",
+    SEAnim.SEANIM_TYPE.SEANIM_TYPE_ADDITIVE: "additive",
+    SEAnim.SEANIM_TYPE.SEANIM_TYPE_RELATIVE: "relative",
+    SEAnim.SEANIM_TYPE.SEANIM_TYPE_DELTA: "delta",
+}
+
+
+def find_files(paths):
+    """
+    Yields (path, root) for every seanim file in paths, where root is the
+    directory the file was found in (used to mirror the directory tree
+    when writing to an output directory)
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.dirname(path)
+            continue
+        for directory, _, names in os.walk(path):
+            for name in sorted(names):
+                if name.lower().endswith(EXTENSIONS):
+                    yield os.path.join(directory, name), path
+
+
+def is_high_precision(header):
+    return bool(header.dataPropertyFlags &
+                SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+
+
+def output_path(path, root, output):
+    if output is None:
+        return path
+    return os.path.join(output, os.path.relpath(path, root))
+
+
+def load(path):
+    """
+    Load an seanim file with columnar (NumPy if available) tracks
+    Raises an exception if the file can't be read
+    """
+    return SEAnim.Anim(path, columnar=True, use_numpy=True,
+                       raise_errors=True)
+
+
+def save(anim, path, high_precision):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    anim.save(path, high_precision,
+              anim.header.animFlags & SEAnim.SEANIM_FLAGS.SEANIM_LOOPED)
+
+
+def count_keys(index):
+    """
+    Returns the number of loc, rot and scale keys in a TrackIndex
+    """
+    tracks = len(SEAnim.TrackIndex.TRACKS)
+    return [sum(index.counts[i::tracks]) for i in range(tracks)]
+
+
+def info(path, root, args):
+    result = SEAnim.probe(path)
+    header = result.header
+    lines = [
+        "type: %s" % ANIM_TYPES.get(header.animType, header.animType),
+        "frames: %d @ %g fps" % (header.frameCount, header.framerate),
+        "bones: %d (%d modifiers)" % (header.boneCount,
+                                      header.boneAnimModifierCount),
+        "notes: %d" % header.noteCount,
+        "precision: %s" % ("double" if is_high_precision(header)
+                           else "float"),
+        "looped: %s" % bool(header.animFlags &
+                            SEAnim.SEANIM_FLAGS.SEANIM_LOOPED),
+    ]
+    return "\n".join("  " + line for line in lines), None
+
+
+def validate(path, root, args):
+    anim = load(path)
+    header = anim.header
+
+    errors = []
+    if header.boneCount != len(anim.bones) and anim.bones:
+        errors.append("bone count is %d, but %d bones were read" %
+                      (header.boneCount, len(anim.bones)))
+    if header.noteCount != len(anim.notes):
+        errors.append("note count is %d, but %d notes were read" %
+                      (header.noteCount, len(anim.notes)))
+
+    for bone in anim.bones:
+        for name, keys in (("loc", bone.posKeys), ("rot", bone.rotKeys),
+                           ("scale", bone.scaleKeys)):
+            frames = keys.frames.tolist() if len(keys) else []
+            if any(a >= b for a, b in zip(frames, frames[1:])):
+                errors.append("'%s' %s keys aren't in ascending order" %
+                              (bone.name, name))
+            if frames and max(frames) >= header.frameCount:
+                errors.append("'%s' %s keys exceed the frame count" %
+                              (bone.name, name))
+
+    for note in anim.notes:
+        if note.frame >= header.frameCount:
+            errors.append("note '%s' exceeds the frame count" % note.name)
+
+    if errors:
+        raise ValueError("; ".join(errors))
+    return None, None
+
+
+def optimize(path, root, args):
+    anim = load(path)
+    # Read before saving, the file may be overwritten
+    size = os.path.getsize(path)
+    before = sum(len(keys) for bone in anim.bones
+                 for keys in (bone.posKeys, bone.rotKeys, bone.scaleKeys))
+    removed = anim.optimize()
+
+    target = output_path(path, root, args.output)
+    if removed or target != path:
+        save(anim, target, is_high_precision(anim.header))
+    return ("  removed %d of %d keys (%d -> %d bytes)" %
+            (removed, before, size, os.path.getsize(target))), None
+
+
+def convert_precision(path, root, args):
+    anim = load(path)
+    high_precision = args.to == 'double'
+
+    target = output_path(path, root, args.output)
+    if high_precision == is_high_precision(anim.header) and target == path:
+        return "  already %s" % args.to, None
+
+    # update_metadata only ever sets the precision flag
+    anim.header.dataPropertyFlags &= (
+        ~SEAnim.SEANIM_PROPERTY_FLAGS.SEANIM_PRECISION_HIGH)
+    save(anim, target, high_precision)
+    return "  converted to %s" % args.to, None
+
+
+def stats(path, root, args):
+    index = SEAnim.TrackIndex.for_file(path)
+    header = index.header
+    return None, {
+        'bones': header.boneCount,
+        'notes': header.noteCount,
+        'frames': header.frameCount,
+        'keys': count_keys(index),
+        'double': int(is_high_precision(header)),
+    }
+
+
+COMMANDS = {
+    'info': info,
+    'validate': validate,
+    'optimize': optimize,
+    'convert-precision': convert_precision,
+    'stats': stats,
+}
+
+
+def run(job):
+    """
+    Run a command for a single file (in a worker process)
+    Returns (path, size, error, message, stats)
+    """
+    path, root, args = job
+    try:
+        size = os.path.getsize(path)
+        message, data = COMMANDS[args.command](path, root, args)
+    except Exception as e:
+        return path, 0, "%s: %s" % (type(e).__name__, e), None, None
+    return path, size, None, message, data
+
+
+def print_stats(totals, count):
+    if not count:
+        return
+    keys = totals['keys']
+    print("files: %d (%d double precision)" % (count, totals['double']))
+    print("bones: %d (%.1f per file)" % (totals['bones'],
+                                         totals['bones'] / count))
+    print("frames: %d (%.1f per file)" % (totals['frames'],
+                                          totals['frames'] / count))
+    print("notes: %d" % totals['notes'])
+    print("keys: %d (loc %d, rot %d, scale %d)" %
+          (sum(keys), keys[0], keys[1], keys[2]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cli_seanim", description="Batch process seanim files")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=os.cpu_count() or 1,
+                        help="the number of worker processes "
+                             "(defaults to the number of cores)")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    for name, text in (("info", "print the header of each file"),
+                       ("validate", "check that each file can be loaded "
+                                    "and its keys are valid"),
+                       ("optimize", "losslessly remove redundant keys"),
+                       ("convert-precision", "convert the keys to float "
+                                             "or double precision"),
+                       ("stats", "print statistics for all of the files")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("paths", nargs="+",
+                             help="seanim files and / or directories")
+        if name in ("optimize", "convert-precision"):
+            command.add_argument("-o", "--output",
+                                 help="write the files to this directory "
+                                      "(instead of overwriting them)")
+        if name == "convert-precision":
+            command.add_argument("--to", choices=("float", "double"),
+                                 required=True)
+
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    jobs = [(path, root, args) for path, root in find_files(args.paths)]
+    totals = {'bones': 0, 'notes': 0, 'frames': 0, 'keys': [0, 0, 0],
+              'double': 0}
+    failed = 0
+    size = 0
+
+    start = time.time()
+    with multiprocessing.Pool(args.jobs) as pool:
+        for path, file_size, error, message, data in pool.imap(
+                run, jobs, chunksize=max(1, len(jobs) // (args.jobs * 8))):
+            size += file_size
+            if error is not None:
+                failed += 1
+                print("%s: FAILED (%s)" % (path, error))
+                continue
+
+            if args.command == 'validate':
+                print("%s: OK" % path)
+            elif message is not None:
+                print("%s:\n%s" % (path, message))
+
+            if data is not None:
+                for key, value in data.items():
+                    if key == 'keys':
+                        totals[key] = [a + b
+                                       for a, b in zip(totals[key], value)]
+                    else:
+                        totals[key] += value
+    elapsed = max(time.time() - start, 1e-9)
+
+    if args.command == 'stats':
+        print_stats(totals, len(jobs) - failed)
+
+    print("%d files (%d failed) in %.2f sec - %.1f files/sec, %.2f MB/sec" %
+          (len(jobs), failed, elapsed, len(jobs) / elapsed,
+           size / (1024 * 1024) / elapsed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,12 @@
 import bpy
-import bpy_types
 from mathutils import *
 from bpy_extras.wm_utils.progress_report import ProgressReport, ProgressReportSubstep
 import os
+import re
+from array import array
+from functools import lru_cache
 from . import seanim as SEAnim
+from .import_seanim import uses_default_inheritance
 
 # <pep8 compliant>
 
@@ -12,6 +15,35 @@ from . import seanim as SEAnim
 # This is the scale multiplier for exported anims
 g_scale = 1  # TODO - Proper scaling
 
+# Matches the data_path of a pose bone property fcurve
+g_pose_bone_path = re.compile(r'pose\.bones\["((?:[^"\\]|\\.)*)"\]\.(\w+)$')
+
+# The index of the keyframe type (0: LOC, 1: ROT, 2: SCALE) that each pose
+# bone property is exported as
+g_key_type_index = {
+    'location': 0,
+    'rotation_quaternion': 1,
+    'rotation_euler': 1,
+    'rotation_axis_angle': 1,
+    'scale': 2,
+}
+
+
+@lru_cache(maxsize=4096)
+def parse_data_path(data_path):
+    """
+    Parse the data_path of an fcurve
+    Returns a (bone name, keyframe type index) tuple, or None if the fcurve
+    isn't for an exported pose bone property
+    """
+    match = g_pose_bone_path.match(data_path)
+    if match is None:
+        return None
+    index = g_key_type_index.get(match.group(2))
+    if index is None:
+        return None
+    return re.sub(r'\\(.)', r'\1', match.group(1)), index
+
 
 def get_loc_vec(bone, anim_type):
     if (anim_type == SEAnim.SEANIM_TYPE.SEANIM_TYPE_ABSOLUTE and
@@ -58,6 +90,151 @@ def gen_scale_key(frame, pose_bone, anim_type):
     return SEAnim.KeyFrame(frame, scale)
 
 
+class PoseSampler(object):
+    """
+    Generates the keys for a pose bone from its current (evaluated) pose
+    The scene must be set to the sampled frame with frame_set first
+    """
+    __slots__ = ('pose_bone',)
+
+    def __init__(self, pose_bone):
+        self.pose_bone = pose_bone
+
+    def gen_loc_key(self, key_frame, frame, anim_type):
+        return gen_loc_key(key_frame, self.pose_bone, anim_type)
+
+    def gen_rot_key(self, key_frame, frame, anim_type):
+        return gen_rot_key(key_frame, self.pose_bone, anim_type)
+
+    def gen_scale_key(self, key_frame, frame, anim_type):
+        return gen_scale_key(key_frame, self.pose_bone, anim_type)
+
+
+class ActionSampler(object):
+    """
+    Generates the keys for a pose bone by evaluating an action's fcurves
+    directly, without evaluating the scene for each frame
+    Only valid for armatures that pass can_sample_action()
+
+    Assuming the default bone inheritance settings, the bone's pose matrix
+    relative to its parent's pose matrix is always rest @ matrix_basis, where
+    'rest' is the bone's rest matrix relative to its parent's - so the parent
+    transforms never need to be evaluated
+    """
+    __slots__ = ('pose_bone', 'rest', 'rest_rot',
+                 'loc', 'rot', 'scale', 'rotation_mode')
+
+    def __init__(self, pose_bone, action):
+        self.pose_bone = pose_bone
+
+        bone = pose_bone.bone
+        rest = bone.matrix_local
+        if bone.parent is not None:
+            rest = bone.parent.matrix_local.inverted() @ rest
+        self.rest = rest
+        self.rest_rot = rest.to_3x3()
+
+        self.rotation_mode = pose_bone.rotation_mode
+        if self.rotation_mode == 'QUATERNION':
+            rot_path = 'rotation_quaternion'
+        elif self.rotation_mode == 'AXIS_ANGLE':
+            rot_path = 'rotation_axis_angle'
+        else:
+            rot_path = 'rotation_euler'
+
+        if bone.use_connect:
+            # Blender ignores the location of connected bones (their
+            # matrix_basis never has a translation), so neither does the
+            # sampler
+            self.loc = [(None, 0.0)] * 3
+        else:
+            self.loc = ActionSampler.get_channel(action, pose_bone,
+                                                 'location')
+        self.rot = ActionSampler.get_channel(action, pose_bone, rot_path)
+        self.scale = ActionSampler.get_channel(action, pose_bone, 'scale')
+
+    @staticmethod
+    def get_channel(action, pose_bone, prop):
+        """
+        Returns a list of (fcurve, default value) pairs for each component of
+        a pose bone property - components without an (unmuted) fcurve keep
+        the property's current value
+        """
+        data_path = pose_bone.path_from_id(prop)
+        channel = []
+        for index, value in enumerate(getattr(pose_bone, prop)):
+            fc = action.fcurves.find(data_path, index=index)
+            if fc is not None and fc.mute:
+                fc = None
+            channel.append((fc, value))
+        return channel
+
+    @staticmethod
+    def evaluate(channel, frame):
+        return [value if fc is None else fc.evaluate(frame)
+                for fc, value in channel]
+
+    def get_rot_matrix(self, frame):
+        value = ActionSampler.evaluate(self.rot, frame)
+        if self.rotation_mode == 'QUATERNION':
+            return Quaternion(value).normalized().to_matrix()
+        elif self.rotation_mode == 'AXIS_ANGLE':
+            axis = Vector(value[1:])
+            if axis.length == 0:
+                return Matrix.Identity(3)
+            return Matrix.Rotation(value[0], 3, axis.normalized())
+        return Euler(value, self.rotation_mode).to_matrix()
+
+    def gen_loc_key(self, key_frame, frame, anim_type):
+        loc = Vector(ActionSampler.evaluate(self.loc, frame))
+        if (anim_type == SEAnim.SEANIM_TYPE.SEANIM_TYPE_ABSOLUTE and
+                self.pose_bone.parent is not None):
+            # Same as get_loc_vec: the translation of rest @ matrix_basis
+            loc = self.rest @ loc
+        loc = loc * g_scale
+        return SEAnim.KeyFrame(key_frame, (loc.x, loc.y, loc.z))
+
+    def gen_rot_key(self, key_frame, frame, anim_type):
+        # Same as get_rot_quat (scale doesn't affect the resulting quaternion)
+        quat = (self.rest_rot @ self.get_rot_matrix(frame)).to_quaternion()
+        return SEAnim.KeyFrame(key_frame, (quat.x, quat.y, quat.z, quat.w))
+
+    def gen_scale_key(self, key_frame, frame, anim_type):
+        scale = ActionSampler.evaluate(self.scale, frame)
+        return SEAnim.KeyFrame(key_frame, tuple(scale))
+
+
+def can_sample_action(ob):
+    """
+    Check whether an armature's pose only depends on its action's fcurves
+    (no constraints, drivers, NLA tracks, partial action influence / blending
+    or non-default bone inheritance), in which case the keys can be generated
+    with an ActionSampler
+    """
+    for data in (ob, ob.data):
+        anim_data = data.animation_data
+        if anim_data is None:
+            continue
+        if len(anim_data.drivers):
+            return False
+        # Blender 2.91 added the action's influence & blending mode
+        if (getattr(anim_data, 'action_influence', 1.0) < 1.0 or
+                getattr(anim_data, 'action_blend_type',
+                        'REPLACE') != 'REPLACE'):
+            return False
+        if anim_data.use_nla and any(not track.mute
+                                     for track in anim_data.nla_tracks):
+            return False
+
+    for pose_bone in ob.pose.bones:
+        if len(pose_bone.constraints):
+            return False
+        if not uses_default_inheritance(pose_bone.bone):
+            return False
+
+    return True
+
+
 def resolve_animtype(self):
     """
     Resolve an SEAnim compatible anim_type integer from the anim_type
@@ -73,15 +250,80 @@ def resolve_animtype(self):
     return type_dict.get(at)
 
 
+def new_bone(self, name):
+    """
+    Create an SEAnim bone with empty (compact) KeyTracks
+    """
+    anim_bone = SEAnim.Bone()
+    anim_bone.name = name
+    anim_bone.posKeys = SEAnim.KeyTrack(3, self.high_precision)
+    anim_bone.rotKeys = SEAnim.KeyTrack(4, self.high_precision)
+    anim_bone.scaleKeys = SEAnim.KeyTrack(3, self.high_precision)
+    return anim_bone
+
+
+def gen_keys(anim_bone, sampler, key_frame, frame, anim_type, use_keys):
+    """
+    Append the (loc, rot, scale) keys enabled in use_keys for a single frame
+    """
+    if use_keys[0]:
+        anim_bone.posKeys.append(sampler.gen_loc_key(
+            key_frame, frame, anim_type))
+    if use_keys[1]:
+        anim_bone.rotKeys.append(sampler.gen_rot_key(
+            key_frame, frame, anim_type))
+    if use_keys[2]:
+        anim_bone.scaleKeys.append(sampler.gen_scale_key(
+            key_frame, frame, anim_type))
+
+
+def write_bone(self, writer, bone):
+    """
+    Add a bone to the writer, reducing its keys first if enabled
+    Returns the number of keys removed by keyframe reduction
+    """
+    removed = 0
+    if self.reduce_keys:
+        # Drop the keys that are reproduced by interpolating between
+        # their neighbours (within the given tolerances)
+        count = len(bone.posKeys) + len(bone.rotKeys) + len(bone.scaleKeys)
+        bone.posKeys = SEAnim.reduce_keys(bone.posKeys,
+                                          self.reduce_tolerance)
+        bone.rotKeys = SEAnim.reduce_keys(bone.rotKeys,
+                                          self.reduce_angle, True)
+        bone.scaleKeys = SEAnim.reduce_keys(bone.scaleKeys,
+                                            self.reduce_tolerance)
+        removed = count - (len(bone.posKeys) + len(bone.rotKeys) +
+                           len(bone.scaleKeys))
+    writer.add_bone(bone.name, bone.posKeys, bone.rotKeys, bone.scaleKeys)
+    return removed
+
+
 def export_action(self, context, progress, action, filepath):
     # print("%s -> %s" % (action.name, filepath)) # DEBUG
 
+    # The file is streamed through the writer one bone at a time, the
+    # header's frame count / presence flags are resolved when it's closed
+    # (the writer discards everything if the export fails)
+    with SEAnim.SEAnimWriter(filepath,
+                             high_precision=self.high_precision,
+                             looping=self.is_looped) as writer:
+        removed = export_action_keys(self, context, progress, action, writer)
+
+    return removed
+
+
+def export_action_keys(self, context, progress, action, writer):
+    """
+    Sample the keys of an action and add them to an SEAnimWriter
+    Returns the number of keys removed by keyframe reduction
+    """
     ob = bpy.context.object
     frame_original = context.scene.frame_current
 
-    anim = SEAnim.Anim()
-    anim.header.animType = resolve_animtype(self)
-    if anim.header.animType is None:
+    header = writer.header
+    header.animType = resolve_animtype(self)
+    if header.animType is None:
         raise Exception('Could not resolve anim type', '%s' % self.anim_type)
         return  # Just to be safe
 
@@ -98,138 +340,130 @@ def export_action(self, context, progress, action, filepath):
         this must be corrected later...
     """
     frame_start = int(action.frame_range[0])
-    anim.header.frameCount = int(
+    header.frameCount = int(
         action.frame_range[1]) - int(action.frame_range[0]) + 1
-    anim.header.framerate = context.scene.render.fps
-
-    use_keys_loc = 'LOC' in self.key_types
-    use_keys_rot = 'ROT' in self.key_types
-    use_keys_scale = 'SCALE' in self.key_types
+    header.framerate = context.scene.render.fps
 
-    anim_bones = {}
+    use_keys = ('LOC' in self.key_types,
+                'ROT' in self.key_types,
+                'SCALE' in self.key_types)
 
-    for pose_bone in ob.pose.bones:
-        anim_bone = SEAnim.Bone()
-        anim_bone.name = pose_bone.name
-        anim_bones[pose_bone.name] = anim_bone
-
-    frames = {}
+    # The frames that each bone is keyed on, and the keyframe types
+    # [LocKey, RotKey, ScaleKey] that are keyed on each of those frames
+    bone_frames = {}
 
     # Step 1: Analyzing Keyframes
     # Resolve the relevent keyframe indices for loc, rot, and / or scale for
     # each bone
     for fc in action.fcurves:
-        try:
-            prop = ob.path_resolve(fc.data_path, False)  # coerce=False
-            if type(prop.data) != bpy_types.PoseBone:
-                raise
-            pose_bone = prop.data
-
-            if prop == pose_bone.location.owner:
-                if not use_keys_loc:
-                    continue
-                # print("LOC")
-                index = 0
-            elif(prop == pose_bone.rotation_quaternion.owner or
-                 prop == pose_bone.rotation_euler.owner or
-                 prop == pose_bone.rotation_axis_angle.owner):
-                if not use_keys_rot:
-                    continue
-                # print("ROT")
-                index = 1
-            elif owner is pose_bone.scale.owner:
-                if not use_keys_scale:
-                    continue
-                # print("SCALE")
-                index = 2
-            else:  # If the fcurve isn't for a valid property, just skip it
-                continue
-        except Exception as e:
-            # The fcurve probably isn't even for a pose bone - just skip it
-            # print("skipping : %s" % e) # DEBUG
-            pass
-        else:
-            for key in fc.keyframe_points:
-                f = int(key.co[0])
-                if frames.get(f) is None:
-                    frames[f] = {}
-                frame_bones = frames[f]
-                if frame_bones.get(pose_bone.name) is None:
-                    # [PoseBone, LocKey, RotKey, ScaleKey]
-                    #  for each bone on the current frame
-                    frame_bones[pose_bone.name] = [
-                        pose_bone, False, False, False]
-                # Enable the corresponding keyframe type for that bone on this
-                # frame
-                frame_bones[pose_bone.name][index + 1] = True
+        # Skip any fcurves that aren't for an exported pose bone property
+        channel = parse_data_path(fc.data_path)
+        if channel is None:
+            continue
+        name, index = channel
+        if not use_keys[index]:
+            continue
+        pose_bone = ob.pose.bones.get(name)
+        if pose_bone is None:
+            continue
+
+        keyed = bone_frames.setdefault(pose_bone.name, {})
+
+        # The keyframe times are read all at once
+        co = array('f', [0.0]) * (len(fc.keyframe_points) * 2)
+        fc.keyframe_points.foreach_get('co', co)
+        for f in dict.fromkeys(int(x) for x in co[0::2]):
+            if keyed.get(f) is None:
+                keyed[f] = [False, False, False]
+            # Enable the corresponding keyframe type for that bone on this
+            # frame
+            keyed[f][index] = True
+
+    frames = set()
+    for keyed in bone_frames.values():
+        frames.update(keyed)
+    frames = sorted(frames)
 
     # Set the frame_count to the the REAL number of frames in the action if
     # there is only 1
     if len(frames) == 1:
-        anim.header.frameCount = 1
+        header.frameCount = 1
 
     # Step 2: Gathering Animation Data
-    if self.every_frame:  # Export every keyframe
-        progress.enter_substeps(anim.header.frameCount)
-        for frame in range(anim.header.frameCount):
-            context.scene.frame_set(frame + frame_start)
-
-            for name, anim_bone in anim_bones.items():
-                pose_bone = ob.pose.bones.get(name)
-                if pose_bone is None:
-                    continue
-
-                if use_keys_loc:
-                    anim_bone.posKeys.append(gen_loc_key(
-                        frame, pose_bone, anim.header.animType))
-                if use_keys_rot:
-                    anim_bone.rotKeys.append(gen_rot_key(
-                        frame, pose_bone, anim.header.animType))
-                if use_keys_scale:
-                    anim_bone.scaleKeys.append(gen_scale_key(
-                        frame, pose_bone, anim.header.animType))
-
-            progress.step()
-
-    else:  # Only export keyed frames
-        progress.enter_substeps(len(frames))
-
-        for frame, bones in frames.items():
-            context.scene.frame_set(frame)
-
-            for name, bone_info in bones.items():
-                anim_bone = anim_bones[name]
-                # the first element in the bone_info array is the PoseBone
-                pose_bone = bone_info[0]
-
-                if use_keys_loc and bone_info[1]:
-                    anim_bone.posKeys.append(gen_loc_key(
-                        frame - frame_start, pose_bone, anim.header.animType))
-                if use_keys_rot and bone_info[2]:
-                    anim_bone.rotKeys.append(gen_rot_key(
-                        frame - frame_start, pose_bone, anim.header.animType))
-                if use_keys_scale and bone_info[3]:
-                    anim_bone.scaleKeys.append(gen_scale_key(
-                        frame - frame_start, pose_bone, anim.header.animType))
+    # Constraints & drivers can move bones without any fcurves, so when the
+    # scene has to be evaluated (with frame_set) for every frame, every bone
+    # is sampled a frame at a time and the keys are only written at the end
+    use_frame_set = not can_sample_action(ob)
+    removed = 0
+
+    if use_frame_set:
+        anim_bones = {pose_bone.name: new_bone(self, pose_bone.name)
+                      for pose_bone in ob.pose.bones}
+        samplers = {pose_bone.name: PoseSampler(pose_bone)
+                    for pose_bone in ob.pose.bones}
+
+        if self.every_frame:  # Export every keyframe
+            progress.enter_substeps(header.frameCount)
+            for frame in range(header.frameCount):
+                context.scene.frame_set(frame + frame_start)
+                for name, sampler in samplers.items():
+                    gen_keys(anim_bones[name], sampler, frame,
+                             frame + frame_start, header.animType, use_keys)
+                progress.step()
+
+        else:  # Only export keyed frames
+            progress.enter_substeps(len(frames))
+            for frame in frames:
+                context.scene.frame_set(frame)
+                for name, keyed in bone_frames.items():
+                    if frame in keyed:
+                        gen_keys(anim_bones[name], samplers[name],
+                                 frame - frame_start, frame,
+                                 header.animType, keyed[frame])
+                progress.step()
+
+        context.scene.frame_set(frame_original)
+        progress.leave_substeps()
+
+        # Step 3: Finalizing Data
+        # Each bone's keys are released as soon as they've been spilled
+        for name in list(anim_bones):
+            removed += write_bone(self, writer, anim_bones.pop(name))
 
+    else:
+        # When nothing but the action affects the pose, the keys are
+        # generated from the action's fcurves directly, one bone at a time -
+        # so only a single bone's keys are held in memory
+        progress.enter_substeps(len(ob.pose.bones))
+        for pose_bone in ob.pose.bones:
+            anim_bone = new_bone(self, pose_bone.name)
+
+            keyed = bone_frames.get(pose_bone.name)
+            if keyed is not None:
+                sampler = ActionSampler(pose_bone, action)
+                if self.every_frame:  # Export every keyframe
+                    for frame in range(header.frameCount):
+                        gen_keys(anim_bone, sampler, frame,
+                                 frame + frame_start, header.animType,
+                                 use_keys)
+                else:  # Only export keyed frames
+                    # The fcurves' keyframe times are merged in the order
+                    # they were found, the keys must be in frame order
+                    for frame, use in sorted(keyed.items()):
+                        gen_keys(anim_bone, sampler, frame - frame_start,
+                                 frame, header.animType, use)
+
+            # Step 3: Finalizing Data
+            removed += write_bone(self, writer, anim_bone)
             progress.step()
-
-    context.scene.frame_set(frame_original)
-    progress.leave_substeps()
-
-    # Step 3: Finalizing Data
-    for name, bone in anim_bones.items():
-        anim.bones.append(bone)
+        progress.leave_substeps()
 
     for pose_marker in action.pose_markers:
-        note = SEAnim.Note()
-        note.frame = pose_marker.frame
-        note.name = pose_marker.name
-        anim.notes.append(note)
+        writer.add_note(pose_marker.frame, pose_marker.name)
 
     # Step 4: Writing File
-    anim.save(filepath, high_precision=self.high_precision,
-              looping=self.is_looped)
+    # (the file is written when the writer is closed)
+    return removed
 
     # DEBUG - Verify that the written file is valid
     # SEAnim.LOG_ANIM_HEADER = True
@@ -260,6 +494,9 @@ def save(self, context):
 
         progress.enter_substeps(len(actions))
 
+        # The number of keys removed by keyframe reduction
+        removed = 0
+
         for action in actions:
             if self.use_actions:
                 filename = prefix + action.name + suffix + ".seanim"
@@ -267,10 +504,14 @@ def save(self, context):
 
             progress.enter_substeps(1, action.name)
             try:
-                export_action(self, context, progress, action, filepath)
+                removed += export_action(self, context, progress, action,
+                                         filepath)
             except Exception as e:
                 progress.leave_substeps("ERROR: " + repr(e))
             else:
                 progress.leave_substeps()
 
         progress.leave_substeps("Finished!")
+
+    if self.reduce_keys:
+        self.report({'INFO'}, "Keyframe reduction removed %d keys" % removed)
@@ -2,7 +2,11 @@ import bpy
 from mathutils import *
 from bpy_extras.wm_utils.progress_report import ProgressReport, ProgressReportSubstep
 import os
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from . import seanim as SEAnim
+from . import cache_seanim
 
 # <pep8 compliant>
 
@@ -14,6 +18,14 @@ g_scale = 1  # TODO - Proper scaling
 # All entries in this list should be lowercase
 DeltaRootBones = ["tag_origin"]
 
+# The number of worker threads used to parse files ahead of the (main thread)
+# fcurve generation when importing multiple files
+g_parse_workers = min(4, os.cpu_count() or 1)
+
+# Parsed anims are kept in memory (for the rest of the session), so
+# re-importing an unchanged file doesn't parse it again
+g_anim_cache = cache_seanim.MemoryCache()
+
 
 def first(a, b):
     """
@@ -24,31 +36,136 @@ def first(a, b):
     """
     for elem in a:
         if elem in b:
-            return a
+            return elem
     return None
 
 
-def ResolvePotentialAnimTypeOverride(bone, boneAnimModifiers):
+def ResolveAnimTypeOverrides(bones, boneAnimModifiers):
     """
-        Attempt to resolve the animType for a bone based on
-         a given list of modifier bones
-        Returns None if no override is needed
+        Resolve the animType override for every bone in 'bones' (the
+         armature's bones) in a single top-down pass over the hierarchy
+        A bone is overridden by the modifier of its nearest (indirect)
+         parent that is in 'boneAnimModifiers' - the modifier only affects
+         the bone's children, not the modifier bone itself
+        Returns a dict of bone name -> animType (None if no override is needed)
     """
-    # + [bone]  # Add [bone] to the parent list if the modifier affects
-    # a bone and its children instead of ONLY the children
-    parents = bone.parent_recursive
-    if len(parents) == 0 or len(boneAnimModifiers) == 0:
-        return None
+    # The first modifier for a given bone name takes priority
+    modifiers = {}
+    for modBone in boneAnimModifiers:
+        modifiers.setdefault(modBone.name, modBone.modifier)
 
-    for parent in parents:
-        for modBone in boneAnimModifiers:
-            if parent.name == modBone.name:
-                # print("'%s' is (indirect) child of '%s'" %
-                #       (bone.name, modBone.name))
-                return modBone.modifier
+    overrides = {}
+    stack = [(bone, None) for bone in bones if bone.parent is None]
+    while stack:
+        bone, override = stack.pop()
+        overrides[bone.name] = override
+        # Children inherit the override of their nearest modifier ancestor
+        override = modifiers.get(bone.name, override)
+        stack.extend((child, override) for child in bone.children)
 
-    # print("'%s' ~default" % (bone.name))
-    return None
+    return overrides
+
+
+def uses_default_inheritance(bone):
+    '''
+        Check whether a bone (bpy.types.Bone) uses the default inheritance
+        settings, in which case its pose matrix is always
+        parent pose @ rest (relative to the parent's rest) @ matrix_basis
+    '''
+    if not bone.use_inherit_rotation or not bone.use_local_location:
+        return False
+    # Blender 2.81 replaced use_inherit_scale with inherit_scale
+    return (getattr(bone, 'inherit_scale', 'FULL') == 'FULL' and
+            getattr(bone, 'use_inherit_scale', True))
+
+
+def get_rest_matrices(bone):
+    '''
+        Get the matrices used to convert SEAnim keys for a pose bone into
+        matrix_basis (location / rotation_quaternion) values with pure math,
+        instead of assigning bone.matrix and reading the result back
+        Returns (rest_inv, rest_rot_inv, rel_inv) where:
+        'rest_inv': The inverse of the bone's rest matrix (relative to its
+                    parent's rest matrix)
+        'rest_rot_inv': The 3x3 rotation part of rest_inv
+        'rel_inv': The inverse of the bone's 3x3 rest matrix (bone.matrix)
+        rest_inv and rest_rot_inv are only valid for bones that pass
+        uses_default_inheritance()
+    '''
+    rest = bone.bone.matrix_local
+    if bone.bone.parent is not None:
+        rest = bone.bone.parent.matrix_local.inverted() @ rest
+    rest_inv = rest.inverted()
+    return rest_inv, rest_inv.to_3x3(), bone.bone.matrix.inverted()
+
+
+class ArmatureCache(object):
+    """
+        Bone lookup tables for an armature, built once and shared by every
+        file in an import batch (until the armature changes)
+    """
+    __slots__ = ('key', 'bone_map', 'delta_root', 'rest_matrices',
+                 'overrides')
+
+    def __init__(self, ob):
+        self.key = ArmatureCache.get_key(ob)
+
+        # Look up table that we use to get a given bone by name
+        # without having to worry about casing
+        self.bone_map = {}
+        for bone in ob.pose.bones:
+            name = bone.name.lower()
+            if name in self.bone_map:
+                print("Warning: Bone name conflict for '%s'\n" % name)
+            self.bone_map[name] = bone
+
+        # The bone used for unnamed (root) bones in delta anims, based on
+        # the prioritized DeltaRootBones array
+        root = first(DeltaRootBones, self.bone_map)
+        self.delta_root = self.bone_map[root] if root is not None else None
+
+        # Per bone results of get_rest_matrices
+        self.rest_matrices = {}
+        # animType overrides for each set of modifiers
+        self.overrides = {}
+
+    @staticmethod
+    def get_key(ob):
+        return (ob.as_pointer(), ob.data.as_pointer(), len(ob.data.bones))
+
+    def is_valid(self, ob):
+        return self.key == ArmatureCache.get_key(ob)
+
+    def get_bone(self, name, animType):
+        """
+            Get the pose bone for an anim bone name (None if there isn't one)
+        """
+        if len(name) == 0:
+            if animType == SEAnim.SEANIM_TYPE.SEANIM_TYPE_DELTA:
+                return self.delta_root
+            return None
+        return self.bone_map.get(name.lower())
+
+    def get_rest_matrices(self, bone):
+        matrices = self.rest_matrices.get(bone.name)
+        if matrices is None:
+            matrices = get_rest_matrices(bone)
+            self.rest_matrices[bone.name] = matrices
+        return matrices
+
+    def get_anim_type_overrides(self, ob, boneAnimModifiers):
+        """
+            Get the animType overrides for the bones of the armature 'ob'
+            Files with the same modifiers share the same results
+        """
+        key = tuple((modBone.name, modBone.modifier)
+                    for modBone in boneAnimModifiers)
+        overrides = self.overrides.get(key)
+        if overrides is None:
+            overrides = ResolveAnimTypeOverrides(ob.data.bones,
+                                                 boneAnimModifiers)
+            self.overrides[key] = overrides
+        return overrides
 
 
 def generate_fcurves(action_fcurves, tag_name, _type, count):
@@ -67,6 +184,87 @@ def generate_fcurves(action_fcurves, tag_name, _type, count):
             for index in range(count)]
 
 
+def parse_seanim(filepath, cache=None):
+    """
+        Parse an seanim file into compact (columnar) keyframe tracks
+        'cache': An optional DiskCache - cached anims skip parsing entirely
+        Anims are looked up in (and added to) g_anim_cache first
+        This doesn't touch bpy, so it's safe to run on a worker thread
+    """
+    anim = g_anim_cache.load(filepath)
+    if anim is not None:
+        return anim
+
+    if cache is not None:
+        anim = cache.load(filepath, use_numpy=True)
+    if anim is None:
+        # Errors are raised, so a failed load is never cached as an empty anim
+        anim = SEAnim.Anim(filepath, columnar=True, use_numpy=True,
+                           raise_errors=True)
+        if cache is not None:
+            cache.save(filepath, anim)
+
+    g_anim_cache.save(filepath, anim)
+    return anim
+
+
+def get_disk_cache(context):
+    """
+        Get the persistent parse cache (None if it's disabled in the addon
+        preferences)
+    """
+    addon = context.preferences.addons.get(__package__)
+    if addon is None or not addon.preferences.use_cache:
+        return None
+    return addon.preferences.get_disk_cache()
+
+
+def parse_files(paths, workers=g_parse_workers, cache=None):
+    """
+        Parse the given files on worker threads, yielding a future for each
+        file in order - files are parsed ahead (up to 2 per worker) while the
+        caller consumes the previous results
+        'cache': An optional DiskCache, passed on to parse_seanim
+        Worker processes aren't used, as the addon (and bpy) can't be
+        imported outside of Blender's own interpreter
+    """
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque(executor.submit(parse_seanim, path, cache)
+                        for _, path in zip(range(workers * 2), paths))
+        while pending:
+            future = pending.popleft()
+            for path in paths:
+                pending.append(executor.submit(parse_seanim, path, cache))
+                break
+            yield future
+
+
+def set_keyframe_points(fcurve, frames, values, control):
+    '''
+        Populate an fcurve's keyframe points in bulk
+        'frames': The frame of each keyframe
+        'values': The value of each keyframe
+        'control': The value of the control keyframe (placed at frame -1)
+                   which is inserted before the other keyframes
+    '''
+    count = len(frames) + 1
+
+    co = array('f', [0.0]) * (2 * count)
+    co[0] = -1
+    co[1] = control
+    co[2::2] = array('f', frames)
+    co[3::2] = array('f', values)
+
+    linear = bpy.types.Keyframe.bl_rna.properties[
+        'interpolation'].enum_items['LINEAR'].value
+
+    points = fcurve.keyframe_points
+    points.add(count)
+    points.foreach_set('co', co)
+    points.foreach_set('interpolation', array('i', [linear]) * count)
+
+
 def load(self, context, filepath=""):
     ob = bpy.context.object
     if ob.type != 'ARMATURE':
@@ -90,11 +288,26 @@ def load(self, context, filepath=""):
         for bone in ob.pose.bones.data.bones:
             bone.rotation_mode = 'QUATERNION'
 
-        for f in self.files:
+        # Parsing happens on worker threads, while the fcurves for each parsed
+        # file are generated here (on the main thread)
+        anim_paths = [os.path.normpath(os.path.join(path, f.name))
+                      for f in self.files]
+        addon = context.preferences.addons.get(__package__)
+        if addon is not None:
+            g_anim_cache.resize(
+                addon.preferences.memory_cache_size * 1024 * 1024)
+
+        parsed = parse_files(anim_paths, cache=get_disk_cache(context))
+
+        # The bone lookup tables are shared by all of the files
+        armature = ArmatureCache(ob)
+
+        for f, anim_path, future in zip(self.files, anim_paths, parsed):
             progress.enter_substeps(1, f.name)
             try:
-                anim_path = os.path.normpath(os.path.join(path, f.name))
-                load_seanim(self, context, progress, anim_path)
+                anim = future.result()
+                load_seanim(self, context, progress, anim_path, anim,
+                            armature)
             except Exception as e:
                 progress.leave_substeps("ERROR: " + repr(e))
             else:
@@ -104,15 +317,18 @@ def load(self, context, filepath=""):
         progress.leave_substeps("Finished!")
 
 
-def load_seanim(self, context, progress, filepath=""):
-    anim = SEAnim.Anim(filepath)
+def load_seanim(self, context, progress, filepath="", anim=None,
+                armature=None):
+    if anim is None:
+        anim = parse_seanim(filepath)
 
     # Import the animation data
     ob = bpy.context.object
 
     bpy.ops.object.mode_set(mode='POSE')
 
-    actionName = os.path.basename(os.path.splitext(filepath)[0])
+    # Compressed anims have a double extension (ie. '.seanim.gz')
+    actionName = os.path.basename(SEAnim.strip_extension(filepath))
     action = bpy.data.actions.new(actionName)
     ob.animation_data.action = action
     ob.animation_data.action.use_fake_user = True
@@ -125,51 +341,33 @@ def load_seanim(self, context, progress, filepath=""):
     # Import the actual keyframes
     progress.enter_substeps(anim.header.boneCount)
 
-    # Look up table that we use to get a given bone by name
-    # without having to worry about casing
-    bone_map = {}
-    for bone in ob.pose.bones:
-        name = bone.name.lower()
-        if name in bone_map:
-            print("Warning: Bone name conflict for '%s'\n" % name)
-        bone_map[bone.name.lower()] = bone
+    if armature is None or not armature.is_valid(ob):
+        armature = ArmatureCache(ob)
+
+    animTypes = armature.get_anim_type_overrides(ob, anim.boneAnimModifiers)
 
     for i, tag in enumerate(anim.bones):
-        try:
-            # Attempt to resolve the root bone name (if it doesn't have one)
-            # based on the prioritized DeltaRootBones array
-            if(len(tag.name) == 0 and
-               anim.header.animType == SEAnim.SEANIM_TYPE.SEANIM_TYPE_DELTA):
-                root = first(DeltaRootBones,
-                             [bone.name.lower() for bone in ob.pose.bones])
-                if root is not None:
-                    tag.name = root
-            bone = bone_map[tag.name.lower()]
-        except:
-            pass
-        else:
-            animType = ResolvePotentialAnimTypeOverride(
-                bone, anim.boneAnimModifiers)
+        # Unnamed bones in delta anims use the delta root bone
+        bone = armature.get_bone(tag.name, anim.header.animType)
+        if bone is not None:
+            animType = animTypes.get(bone.name)
             if animType is None:
                 animType = anim.header.animType
 
+            rest_inv, rest_rot_inv, rel_inv = armature.get_rest_matrices(bone)
+            # Bones with non-default inheritance settings are converted by
+            # assigning their pose matrix and reading the result back, which
+            # goes through Blender's own pose-to-bone conversion
+            use_rest = uses_default_inheritance(bone.bone)
+
             # Import the position keyframes
             if len(tag.posKeys):
                 bone.matrix_basis.identity()
+                control = tuple(bone.location)
 
-                fcurves = generate_fcurves(action.fcurves, bone.name,
-                                           'location', 3)
-                keyCount = len(tag.posKeys)
-                for axis, fcurve in enumerate(fcurves):
-                    fcurve.color_mode = 'AUTO_RGB'
-                    # Add an extra keyframe for the control keyframe
-                    fcurve.keyframe_points.add(keyCount + 1)
-                    # Add the control keyframe # Can be changed to Vector((-1,
-                    # 0)) because Location 0,0,0 is rest pos
-                    fcurve.keyframe_points[0].co = Vector(
-                        (-1, bone.location[axis]))
-
-                for k, key in enumerate(tag.posKeys):
+                frames = []
+                values = []
+                for key in tag.posKeys:
                     # Currently the conversion is only here because I never
                     # added scaling options for Blender-CoD
                     offset = Vector(key.data) * g_scale
@@ -178,97 +376,99 @@ def load_seanim(self, context, progress, filepath=""):
                     # j_gun has a SEANIM_TYPE_RELATIVE override
                     if (animType == SEAnim.SEANIM_TYPE.SEANIM_TYPE_ABSOLUTE and
                             bone.parent is not None):
-                        bone.matrix.translation = bone.parent.matrix @ offset
+                        if use_rest:
+                            # Same as setting bone.matrix.translation to
+                            # bone.parent.matrix @ offset (the parent's pose
+                            # matrix cancels out)
+                            loc = rest_inv @ offset
+                        else:
+                            bone.matrix.translation = (
+                                bone.parent.matrix @ offset)
+                            loc = bone.location
                     # SEANIM_TYPE_RELATIVE
                     elif animType == SEAnim.SEANIM_TYPE.SEANIM_TYPE_RELATIVE:
-                        bone.matrix_basis.translation = bone.bone.matrix.inverted() @ offset
+                        loc = rel_inv @ offset
                     # Use DELTA / RELATIVE results (ADDITIVE is unknown)
                     else:
-                        bone.matrix_basis.translation = offset
+                        loc = offset
 
-                    # bone.keyframe_insert("location", index=-1, frame=key.frame, group=tag.name)  # nopep8
-                    for axis, fcurve in enumerate(fcurves):
-                        fcurve.keyframe_points[k + 1].co = Vector((key.frame, bone.location[axis]))  # nopep8
-                        fcurve.keyframe_points[k + 1].interpolation = 'LINEAR'
+                    frames.append(key.frame)
+                    values.append(tuple(loc))
 
-                # Update the FCurves
-                for fc in fcurves:
-                    fc.update()
+                # The keyframe points for each axis are set all at once
+                fcurves = generate_fcurves(action.fcurves, bone.name,
+                                           'location', 3)
+                for axis, fcurve in enumerate(fcurves):
+                    fcurve.color_mode = 'AUTO_RGB'
+                    set_keyframe_points(fcurve, frames,
+                                        [value[axis] for value in values],
+                                        control[axis])
+                    fcurve.update()
 
             # Import the rotation keyframes
             if len(tag.rotKeys):
                 bone.matrix_basis.identity()
 
-                fcurves = generate_fcurves(action.fcurves, bone.name,
-                                           'rotation_quaternion', 4)
-                keyCount = len(tag.rotKeys)
-                for axis, fcurve in enumerate(fcurves):
-                    fcurve.color_mode = 'AUTO_YRGB'
-                    # Add an extra keyframe for the control keyframe
-                    fcurve.keyframe_points.add(keyCount + 1)
-                    fcurve.keyframe_points[0].co = Vector(
-                        (-1, [1, 0, 0, 0][axis]))  # Add the control keyframe
-
-                for k, key in enumerate(tag.rotKeys):
+                frames = []
+                values = []
+                for key in tag.rotKeys:
                     # Convert the Quaternion to WXYZ
                     quat = Quaternion(
                         (key.data[3], key.data[0], key.data[1], key.data[2]))
                     angle = quat.to_matrix().to_3x3()
 
-                    bone.matrix_basis.identity()
-                    if bone.parent is None:
-                        # I don't actually remember why this is here - probably
-                        # to set the root bone(s) to its rest pos / angle
-                        bone.matrix_basis.identity()
-                        mat = angle.to_4x4()
+                    if use_rest:
+                        # Same as setting bone.matrix to the angle (in the
+                        # parent's pose space for child bones) and reading
+                        # bone.rotation_quaternion back - the parent's pose
+                        # matrix cancels out, leaving the rest rotation
+                        quat = (rest_rot_inv @ angle).to_quaternion()
                     else:
-                        mat = (bone.parent.matrix.to_3x3() @ angle).to_4x4()
-
-                    bone.matrix = mat
+                        bone.matrix_basis.identity()
+                        if bone.parent is None:
+                            mat = angle.to_4x4()
+                        else:
+                            mat = (bone.parent.matrix.to_3x3() @
+                                   angle).to_4x4()
+                        bone.matrix = mat
+                        quat = bone.rotation_quaternion
 
-                    quat = bone.rotation_quaternion
-                    for axis, fcurve in enumerate(fcurves):
-                        # bone.rotation_quaternion[axis]
-                        fcurve.keyframe_points[k + 1].co = Vector((key.frame, quat[axis]))  # nopep8
-                        fcurve.keyframe_points[k + 1].interpolation = 'LINEAR'
+                    frames.append(key.frame)
+                    values.append(tuple(quat))
 
-                # Update the FCurves
-                for fc in fcurves:
-                    fc.update()
+                fcurves = generate_fcurves(action.fcurves, bone.name,
+                                           'rotation_quaternion', 4)
+                for axis, fcurve in enumerate(fcurves):
+                    fcurve.color_mode = 'AUTO_YRGB'
+                    set_keyframe_points(fcurve, frames,
+                                        [value[axis] for value in values],
+                                        [1, 0, 0, 0][axis])
+                    fcurve.update()
 
             # Import the scale keyframes
             if len(tag.scaleKeys):
                 bone.matrix_basis.identity()
+                control = tuple(bone.scale)
+
+                frames = [key.frame for key in tag.scaleKeys]
+                values = [key.data for key in tag.scaleKeys]
 
                 fcurves = generate_fcurves(action.fcurves, bone.name,
                                            'scale', 3)
-                keyCount = len(tag.scaleKeys)
                 for axis, fcurve in enumerate(fcurves):
                     fcurve.color_mode = 'AUTO_RGB'
-                    # Add an extra keyframe for the control keyframe
-                    fcurve.keyframe_points.add(keyCount + 1)
-                    fcurve.keyframe_points[0].co = Vector(
-                        (-1, bone.scale[axis]))  # Add the control keyframe
-
-                for k, key in enumerate(tag.scaleKeys):
-                    scale = Vector(key.data)
-
-                    for axis, fcurve in enumerate(fcurves):
-                        fcurve.keyframe_points[
-                            k + 1].co = Vector((key.frame, scale[axis]))
-                        fcurve.keyframe_points[k + 1].interpolation = 'LINEAR'
-
-                # Update the FCurves
-                for fc in fcurves:
-                    fc.update()
+                    set_keyframe_points(fcurve, frames,
+                                        [value[axis] for value in values],
+                                        control[axis])
+                    fcurve.update()
 
             frame = scene.frame_start - 1
             bone.keyframe_delete(data_path="location",
-                                 frame=frame, group=tag.name)
+                                 frame=frame, group=bone.name)
             bone.keyframe_delete(data_path="rotation_quaternion",
-                                 frame=frame, group=tag.name)
+                                 frame=frame, group=bone.name)
             bone.keyframe_delete(data_path="scale",
-                                 frame=frame, group=tag.name)
+                                 frame=frame, group=bone.name)
 
             # Remove any leftover temporary transformations for this bone
             bone.matrix_basis.identity()
@@ -0,0 +1,278 @@
+"""
+Tests for seanim.py (doesn't require Blender)
+
+Run from the addon's directory:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import seanim as SEAnim  # noqa: E402
+import cache_seanim  # noqa: E402
+from bench_seanim import Case, generate_anim  # noqa: E402
+
+# <pep8 compliant>
+
+# Small versions of the benchmark corpus, which still cover the edges of the
+# format: 1, 2 and 4 byte frame_t and bone_t, float / double precision,
+# modifiers, notes, sparse keys and files without any bone keys
+CORPUS = (
+    Case('frame_u8', 5, 20, modifiers=2, notes=4),
+    Case('frame_u16', 3, 300, sparse=True, notes=3),
+    Case('frame_u32', 2, 0x10000 + 100, sparse=True),
+    Case('bone_u16', 0x100 + 16, 2, modifiers=3, tracks=('rot',)),
+    Case('bone_u32', 0x10000 + 16, 1, modifiers=2, tracks=('rot',)),
+    Case('double', 4, 30, high_precision=True, modifiers=1, notes=2),
+    Case('loc_scale', 3, 10, tracks=('loc', 'scale')),
+    Case('notes_only', 3, 10, notes=5, tracks=()),
+)
+
+# The bone_u32 case is only loaded as a whole (it's slow to decode)
+LARGE = ('bone_u32',)
+
+TRACKS = (SEAnim.SEANIM_PRESENCE_FLAGS.SEANIM_BONE_LOC,
+          SEAnim.SEANIM_PRESENCE_FLAGS.SEANIM_BONE_ROT,
+          SEAnim.SEANIM_PRESENCE_FLAGS.SEANIM_BONE_SCALE)
+
+
+def dump_keys(keys):
+    return [(key.frame, tuple(key.data)) for key in keys]
+
+
+def dump(anim):
+    """
+    A comparable representation of an anim's bones, keys and notes
+    """
+    bones = [(bone.name, bone.modifier if bone.useModifier else None,
+              dump_keys(bone.posKeys), dump_keys(bone.rotKeys),
+              dump_keys(bone.scaleKeys))
+             for bone in anim.bones]
+    return bones, [(note.frame, note.name) for note in anim.notes]
+
+
+def make_track(frames, width=3):
+    track = SEAnim.KeyTrack(width)
+    for frame in frames:
+        track.append(SEAnim.KeyFrame(frame, (float(frame),) * width))
+    return track
+
+
+class RoundTripTest(unittest.TestCase):
+    """
+    Every reader / writer must reproduce the generated files exactly
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        # (case, path, file contents, expected dump)
+        cls.files = []
+        for case in CORPUS:
+            anim = generate_anim(case)
+            if not case.tracks:
+                # The bones aren't stored without any bone keys
+                anim.bones = []
+                anim.boneAnimModifiers = []
+            path = os.path.join(cls.directory, case.name + ".seanim")
+            anim.save(path, case.high_precision)
+            with open(path, "rb") as file:
+                data = file.read()
+
+            cls.files.append((case, path, data, dump(anim)))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def small_files(self):
+        return [entry for entry in self.files if entry[0].name not in LARGE]
+
+    def test_load(self):
+        modes = [{}, {'columnar': True}]
+        if SEAnim.numpy is not None:
+            modes.append({'use_numpy': True})
+
+        for case, path, data, expected in self.files:
+            for options in modes:
+                with self.subTest(case=case.name, **options):
+                    anim = SEAnim.Anim(path, **options)
+                    self.assertEqual(dump(anim), expected)
+                    self.assertEqual(anim.to_bytes(case.high_precision), data)
+
+    def test_open(self):
+        for case, path, data, expected in self.small_files():
+            with self.subTest(case=case.name):
+                # Untouched tracks are copied as is
+                with SEAnim.Anim.open(path) as anim:
+                    self.assertEqual(anim.to_bytes(case.high_precision),
+                                     data)
+                    for bone in anim.bones:
+                        for keys in (bone.posKeys, bone.rotKeys,
+                                     bone.scaleKeys):
+                            if isinstance(keys, SEAnim.LazyTrack):
+                                self.assertIsNone(keys.keys)
+
+                with SEAnim.Anim.open(path, columnar=True) as anim:
+                    self.assertEqual(dump(anim), expected)
+                    self.assertEqual(anim.to_bytes(case.high_precision),
+                                     data)
+
+    def test_iter_bones(self):
+        for case, path, data, expected in self.small_files():
+            with self.subTest(case=case.name):
+                bones = []
+                notes = []
+                for item in SEAnim.iter_bones(path):
+                    if isinstance(item, SEAnim.Note):
+                        notes.append((item.frame, item.name))
+                        continue
+                    name, modifier, posKeys, rotKeys, scaleKeys = item
+                    bones.append((name, modifier, dump_keys(posKeys),
+                                  dump_keys(rotKeys), dump_keys(scaleKeys)))
+                self.assertEqual((bones, notes), expected)
+
+    def test_probe(self):
+        for case, path, data, expected in self.small_files():
+            with self.subTest(case=case.name):
+                anim = SEAnim.Anim(path)
+                result = SEAnim.probe(path)
+                header = result.header
+                self.assertEqual(
+                    (header.frameCount, header.boneCount, header.noteCount,
+                     header.dataPresenceFlags, header.dataPropertyFlags),
+                    (anim.header.frameCount, anim.header.boneCount,
+                     anim.header.noteCount, anim.header.dataPresenceFlags,
+                     anim.header.dataPropertyFlags))
+                self.assertEqual([(note.frame, note.name)
+                                  for note in result.notes], expected[1])
+
+    def test_track_index(self):
+        for case, path, data, expected in self.small_files():
+            with self.subTest(case=case.name):
+                index = SEAnim.TrackIndex.for_file(path)
+                self.assertEqual(index.names,
+                                 [bone[0] for bone in expected[0]])
+                with open(path, "rb") as file:
+                    for i, bone in enumerate(expected[0]):
+                        for track, keys in zip(TRACKS, bone[2:]):
+                            if not keys:
+                                continue
+                            self.assertEqual(
+                                dump_keys(index.loadKeys(file, i, track)),
+                                keys)
+
+    def test_writer(self):
+        for case, path, data, expected in self.small_files():
+            with self.subTest(case=case.name):
+                anim = SEAnim.Anim(path)
+                columns = SEAnim.Anim(path, columnar=True)
+                output = os.path.join(self.directory, "writer.seanim")
+                with SEAnim.SEAnimWriter(output,
+                                         case.high_precision) as writer:
+                    writer.header.animType = anim.header.animType
+                    writer.header.framerate = anim.header.framerate
+                    # Both lists of KeyFrames and KeyTracks are accepted
+                    for i, (bone, source) in enumerate(
+                            zip(anim.bones, columns.bones)):
+                        if i % 2:
+                            source = bone
+                        writer.add_bone(bone.name, source.posKeys,
+                                        source.rotKeys, source.scaleKeys,
+                                        bone.modifier if bone.useModifier
+                                        else None)
+                    for note in anim.notes:
+                        writer.add_note(note.frame, note.name)
+
+                with open(output, "rb") as file:
+                    self.assertEqual(file.read(), data)
+
+    def test_writer_without_bone_keys(self):
+        # The bone section is skipped when no bone has any keys, so the
+        # notes must directly follow the header
+        output = os.path.join(self.directory, "writer.seanim")
+        with SEAnim.SEAnimWriter(output) as writer:
+            writer.add_bone("unkeyed")
+            writer.add_note(3, "note")
+        anim = SEAnim.Anim(output)
+        self.assertEqual(dump(anim), ([], [(3, "note")]))
+
+    def test_compressed(self):
+        for case, path, data, expected in self.small_files():
+            anim = SEAnim.Anim(path, columnar=True)
+            for extensions, magic, codec, options in SEAnim.COMPRESSION:
+                with self.subTest(case=case.name, codec=extensions[0]):
+                    output = os.path.join(self.directory,
+                                          "compressed.seanim" + extensions[0])
+                    anim.save(output, case.high_precision)
+                    with open(output, "rb") as file:
+                        self.assertTrue(file.read().startswith(magic))
+                    with SEAnim.open_file(output) as file:
+                        self.assertEqual(file.read(), data)
+                    self.assertEqual(dump(SEAnim.Anim(output)), expected)
+
+    def test_disk_cache(self):
+        cache = cache_seanim.DiskCache(os.path.join(self.directory, "cache"))
+        for case, path, data, expected in self.small_files():
+            with self.subTest(case=case.name):
+                self.assertIsNone(cache.load(path))
+                cache.save(path, SEAnim.Anim(path))
+                for use_numpy in (False, True):
+                    anim = cache.load(path, use_numpy)
+                    self.assertEqual(dump(anim), expected)
+                    self.assertEqual(anim.to_bytes(case.high_precision),
+                                     data)
+        self.assertEqual(cache.clear(), len(self.small_files()))
+
+
+class ReduceKeysTest(unittest.TestCase):
+
+    def test_short_tracks(self):
+        # Tracks with fewer than 3 keys have nothing to reduce
+        for frames in ([], [0], [0, 10]):
+            for rotation in (False, True):
+                width = 4 if rotation else 3
+                track = make_track(frames, width)
+                result = SEAnim.reduce_keys(track, 0.001, rotation)
+                self.assertEqual(result.frames.tolist(), frames)
+
+                keys = list(make_track(frames, width))
+                result = SEAnim.reduce_keys(keys, 0.001, rotation)
+                self.assertEqual([key.frame for key in result], frames)
+
+    def test_linear_keys(self):
+        # The interior keys of a linear track are reproduced by
+        # interpolating between the first and last keys
+        track = make_track(range(10))
+        result = SEAnim.reduce_keys(track, 0.001)
+        self.assertEqual(result.frames.tolist(), [0, 9])
+
+    def test_keeps_input_kind(self):
+        # Lists of KeyFrames are reduced in place of converting them to
+        # (float precision) KeyTracks
+        keys = [SEAnim.KeyFrame(frame, (0.1, 0.0, frame * 0.5))
+                for frame in range(10)]
+        result = SEAnim.reduce_keys(keys, 0.001)
+        self.assertEqual(result, [keys[0], keys[-1]])
+
+        track = SEAnim.KeyTrack(3, high_precision=True)
+        for key in keys:
+            track.append(key)
+        result = SEAnim.reduce_keys(track, 0.001)
+        self.assertEqual(result.values.typecode, 'd')
+        self.assertEqual(result.values[0], 0.1)
+
+    def test_keeps_peak(self):
+        track = SEAnim.KeyTrack(3)
+        for frame, value in ((0, 0.0), (5, 1.0), (10, 0.0)):
+            track.append(SEAnim.KeyFrame(frame, (value, 0.0, 0.0)))
+        result = SEAnim.reduce_keys(track, 0.001)
+        self.assertEqual(result.frames.tolist(), [0, 5, 10])
+
+
+if __name__ == "__main__":
+    unittest.main()